@@ -0,0 +1,208 @@
+"""
+chunking.py - Claude Code セッションログ (jsonl) のパースとチャンク分割
+
+ingest.py のパースワーカー（spawnで起動）が読み込むモジュール。
+ワーカーごとに numpy / onnxruntime / transformers を読み込まないよう、
+標準ライブラリと orjson だけに依存させる。
+"""
+
+import re
+from datetime import datetime
+from pathlib import Path
+
+import orjson
+
+# --- 設定 ---
+WINDOW_SIZE = 4  # user/assistantペア数
+WINDOW_STEP = 2  # スライドステップ
+MAX_CHUNK_CHARS = 2000  # チャンクの最大文字数
+
+# 除外するメッセージtype
+SKIP_TYPES = {"system", "progress", "file-history-snapshot", "queue-operation"}
+
+_SYS_REMINDER_RE = re.compile(r"<system-reminder>.*?</system-reminder>", re.DOTALL)
+_TOOL_INPUT_KEYS = ("command", "query", "pattern", "file_path", "prompt", "url")  # tool_use要約に残す入力
+
+
+def extract_text_from_content(content) -> str:
+    """メッセージのcontentからテキストを抽出する"""
+    if isinstance(content, str):
+        return content
+
+    if isinstance(content, list):
+        parts = []
+        for item in content:
+            if not isinstance(item, dict):
+                continue
+            item_type = item.get("type", "")
+
+            if item_type == "text":
+                text = item.get("text", "")
+                # system-reminderタグを除去（タグがなければ正規表現を走らせない）
+                if "<system-reminder>" in text:
+                    text = _SYS_REMINDER_RE.sub("", text)
+                text = text.strip()
+                if text:
+                    parts.append(text)
+
+            elif item_type == "tool_use":
+                tool_name = item.get("name", "unknown")
+                tool_input = item.get("input", {})
+                summary_parts = []
+                if isinstance(tool_input, dict):
+                    for key in _TOOL_INPUT_KEYS:
+                        if key in tool_input:
+                            val = str(tool_input[key])[:100]
+                            summary_parts.append(f"{key}={val}")
+                input_summary = ", ".join(summary_parts) if summary_parts else ""
+                parts.append(f"[tool: {tool_name}({input_summary})]")
+
+            elif item_type == "tool_result":
+                result_content = item.get("content", "")
+                if isinstance(result_content, str):
+                    result_text = result_content[:150]
+                elif isinstance(result_content, list):
+                    texts = []
+                    total = 0
+                    for rc in result_content:
+                        if isinstance(rc, dict) and rc.get("type") == "text":
+                            t = str(rc.get("text", ""))[:100]
+                            texts.append(t)
+                            total += len(t) + 1
+                            if total > 150:
+                                # 以降の要素は切り詰め後の150文字に入らない
+                                break
+                    result_text = " ".join(texts)[:150]
+                else:
+                    result_text = ""
+                if result_text:
+                    parts.append(f"[result: {result_text}]")
+
+        return " ".join(parts)
+
+    return ""
+
+
+def parse_jsonl(filepath: Path) -> list[dict]:
+    """jsonlファイルからuser/assistantメッセージを抽出する"""
+    messages = []
+    session_id = filepath.stem
+
+    # バイト列のままorjsonに渡す（行ごとのUTF-8デコードを省く）。読み込みは1MBバッファ
+    with open(filepath, "rb", buffering=1 << 20) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                obj = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+
+            msg_type = obj.get("type", "")
+
+            if msg_type in SKIP_TYPES:
+                continue
+
+            if msg_type not in ("user", "assistant"):
+                continue
+
+            role = msg_type
+            content = None
+
+            if "message" in obj:
+                msg = obj["message"]
+                role = msg.get("role", msg_type)
+                content = msg.get("content")
+            elif "content" in obj:
+                content = obj["content"]
+            else:
+                continue
+
+            text = extract_text_from_content(content)
+            if not text or len(text.strip()) < 5:
+                continue
+
+            timestamp = obj.get("timestamp", "")
+
+            messages.append({
+                "role": role,
+                "text": text,
+                "timestamp": timestamp,
+                "session_id": session_id,
+            })
+
+    return messages
+
+
+def create_chunks(messages: list[dict], session_id: str, project_path: str) -> list[dict]:
+    """user/assistantペアのスライディングウィンドウでチャンクを作る"""
+    # 各userメッセージを直後のassistantと組にする（直後がassistantでなければ単独）。
+    # assistantがペアの先頭になることはないので、添字を進める分岐なしの1パスで済む
+    pairs = []
+    for msg, next_msg in zip(messages, messages[1:] + [None]):
+        if msg["role"] == "user":
+            if next_msg is not None and next_msg["role"] == "assistant":
+                pairs.append((msg, next_msg))
+            else:
+                pairs.append((msg, None))
+
+    if not pairs:
+        return []
+
+    chunks = []
+    chunk_index = 0
+
+    for start in range(0, len(pairs), WINDOW_STEP):
+        end = min(start + WINDOW_SIZE, len(pairs))
+        window = pairs[start:end]
+
+        if not window:
+            break
+
+        lines = []
+        for user_msg, assistant_msg in window:
+            user_text = user_msg["text"][:500]
+            lines.append(f"User: {user_text}")
+            if assistant_msg:
+                assistant_text = assistant_msg["text"][:500]
+                lines.append(f"Assistant: {assistant_text}")
+
+        chunk_text = "\n".join(lines)
+        if len(chunk_text) > MAX_CHUNK_CHARS:
+            chunk_text = chunk_text[:MAX_CHUNK_CHARS]
+
+        timestamp = window[0][0].get("timestamp", "")
+
+        chunk_id = f"{session_id}:{chunk_index}"
+
+        timestamp_epoch = 0.0
+        if timestamp:
+            try:
+                dt = datetime.fromisoformat(str(timestamp).replace("Z", "+00:00"))
+                timestamp_epoch = dt.timestamp()
+            except Exception:
+                pass
+
+        chunks.append({
+            "id": chunk_id,
+            "text": chunk_text,
+            "prefixed": f"passage: {chunk_text}",  # e5のpassageプレフィックス付き（embedding用）
+            "metadata": {
+                "session_id": session_id,
+                "project_path": project_path,
+                "timestamp": str(timestamp),
+                "timestamp_epoch": timestamp_epoch,
+                "chunk_index": chunk_index,
+            },
+        })
+        chunk_index += 1
+
+    return chunks
+
+
+def _parse_and_chunk(filepath: Path, project_path: str) -> list[dict]:
+    """1ファイル分のパース + チャンク分割（ファイルが多いときはワーカープロセスで実行される）"""
+    messages = parse_jsonl(filepath)
+    if not messages:
+        return []
+    return create_chunks(messages, filepath.stem, project_path)
@@ -2,39 +2,141 @@
 ingest.py - Claude Code セッションログを SQLite (sqlite-vec + FTS5) に格納する
 
 jsonlファイルをパースし、user/assistantペアのスライディングウィンドウで
-チャンク分割、multilingual-e5-small でembeddingして SQLite に保存する。
+チャンク分割、multilingual-e5-small (ONNX Runtime, INT8量子化) でembeddingして SQLite に保存する。
 増分更新対応: 既にインデックス済みのファイルはスキップする。
+
+ベクトル検索は sqlite-vec の vec0 による全件走査（HNSWのようなグラフ索引はなく、
+ef などの探索パラメータもない）なので、検索時間はDBのページ読み出しに比例する。
+接続ごとに mmap_size を設定し、ページをOSのページキャッシュから直接読むことで
+read() のコピーを省き、サーバーの連続クエリでもホットなベクトルをキャッシュに残す。
+代わりに仮想アドレス空間をDBサイズ分（上限 SQLITE_MMAP_SIZE）使い、
+ディスクI/Oエラーは例外ではなくSIGBUSになる。
 """
 
-import json
+import itertools
+import multiprocessing
 import os
 import re
-import hashlib
+import shutil
 import sqlite3
-import struct
+import sys
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
-from datetime import datetime
 
+import numpy as np
 import sqlite_vec
-from sentence_transformers import SentenceTransformer
+
+from chunking import _parse_and_chunk
 
 # --- 設定 ---
 PROJECTS_DIR = Path.home() / ".claude" / "projects"
 DATA_DIR = Path(__file__).parent / "data"
 SQLITE_PATH = DATA_DIR / "memory.sqlite3"
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024  # メモリマップするDBの最大バイト数
+# ONNXエクスポート + INT8量子化済みモデルのキャッシュ。書き出し完了後にリネームで作るので、
+# ディレクトリがあれば中身は揃っている。量子化設定を変えたらディレクトリ名も変える
+ONNX_DIR = DATA_DIR / "onnx" / "e5-small-int8-avx2"
+ONNX_MODEL_FILE = "model_quantized.onnx"
 EMBEDDING_MODEL = "intfloat/multilingual-e5-small"
 EMBEDDING_DIM = 384
-WINDOW_SIZE = 4  # user/assistantペア数
-WINDOW_STEP = 2  # スライドステップ
-MAX_CHUNK_CHARS = 2000  # チャンクの最大文字数
-
-# 除外するメッセージtype
-SKIP_TYPES = {"system", "progress", "file-history-snapshot", "queue-operation"}
-
-
-def serialize_f32(vec: list[float]) -> bytes:
-    """float list → little-endian bytes for sqlite-vec"""
-    return struct.pack(f"<{len(vec)}f", *vec)
+# トークン長バケットごとの (最大トークン長, バッチサイズ)。短いほど大きなバッチで回す
+ENCODE_BUCKETS = [(128, 128), (256, 64), (384, 32), (512, 16)]
+EMBED_THREADS = int(os.environ.get("EMBED_THREADS", "4"))  # embedding推論のスレッド数（ホストごとに調整）
+WRITE_BATCH_SIZE = 1000  # このチャンク数が溜まったらファイル横断でまとめてembedding + 書き込みする
+PARSE_WORKERS = os.cpu_count() or 1  # jsonlパース + チャンク分割のプロセス数
+
+_PROJECT_PREFIX_RE = re.compile(r"^-mnt-c-Users-[^-]+-")
+
+
+def export_onnx_model(output_dir: Path):
+    """HFモデルをONNXにエクスポートし、INT8動的量子化して output_dir に保存する（初回のみ）
+
+    同じ親ディレクトリの一時ディレクトリにモデルとトークナイザを書き出し、
+    揃ってから output_dir へリネームする。途中で落ちても書きかけの output_dir は残らず、
+    サーバーのウォームアップとフックのingestが同時に書き出しても先に終わった方が使われる。
+    """
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    output_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f".{output_dir.name}.", dir=output_dir.parent))
+    try:
+        ort_model = ORTModelForFeatureExtraction.from_pretrained(EMBEDDING_MODEL, export=True)
+        quantizer = ORTQuantizer.from_pretrained(ort_model)
+        # VNNIのないAVX2ホスト（一般的なWSLのノートPCなど）ではU8S8の積和が飽和しうるので、
+        # 重みを7bitに抑える reduce_range を付ける（VNNIホストでも精度が少し落ちるだけで動く）
+        qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=False, reduce_range=True)
+        quantizer.quantize(save_dir=tmp_dir, quantization_config=qconfig)
+        AutoTokenizer.from_pretrained(EMBEDDING_MODEL).save_pretrained(tmp_dir)
+        try:
+            os.replace(tmp_dir, output_dir)
+        except OSError:
+            # 別プロセスが先に書き出し終えていればそれを使う
+            if not output_dir.is_dir():
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class EmbeddingModel:
+    """ONNX Runtime で multilingual-e5-small を動かすembeddingモデル
+
+    SentenceTransformer と同じく mean pooling + L2正規化したベクトルを返す。
+    """
+
+    max_seq_length = 512
+
+    def __init__(self):
+        # spawnされたパースワーカーも ingest.py を読み込むので、推論ライブラリはここで読む
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        if not ONNX_DIR.is_dir():
+            export_onnx_model(ONNX_DIR)
+        self.tokenizer = AutoTokenizer.from_pretrained(str(ONNX_DIR))
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = EMBED_THREADS
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            str(ONNX_DIR / ONNX_MODEL_FILE),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def encode(self, texts: str | list[str], batch_size: int = 32) -> np.ndarray:
+        """テキスト（またはそのリスト）をembeddingする"""
+        if isinstance(texts, str):
+            return self.encode([texts], batch_size)[0]
+
+        results = []
+        for start in range(0, len(texts), batch_size):
+            # パディングはバッチ内の最大長まで
+            inputs = self.tokenizer(
+                texts[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np",
+            )
+            feed = {k: v for k, v in inputs.items() if k in self.input_names}
+            # BERT系のONNXグラフは token_type_ids を要求するが、XLM-Rトークナイザは返さない
+            if "token_type_ids" in self.input_names and "token_type_ids" not in feed:
+                feed["token_type_ids"] = np.zeros_like(inputs["input_ids"])
+            hidden = self.session.run(["last_hidden_state"], feed)[0]
+
+            # mean pooling + L2正規化
+            mask = inputs["attention_mask"][..., np.newaxis].astype(hidden.dtype)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            results.append(pooled / np.linalg.norm(pooled, axis=1, keepdims=True))
+
+        if not results:
+            return np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        return np.concatenate(results)
 
 
 def get_db() -> sqlite3.Connection:
@@ -43,6 +145,7 @@ def get_db() -> sqlite3.Connection:
     db = sqlite3.connect(str(SQLITE_PATH))
     db.enable_load_extension(True)
     sqlite_vec.load(db)
+    db.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
     # スキーマ作成（冪等）
     db.execute("""
         CREATE TABLE IF NOT EXISTS chunks (
@@ -59,6 +162,22 @@ def get_db() -> sqlite3.Connection:
         CREATE INDEX IF NOT EXISTS idx_chunks_session
         ON chunks(session_id)
     """)
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            mtime_ns INTEGER,
+            size INTEGER
+        )
+    """)
+    # sessionsテーブル導入前のDBや、空のDBにmigrate.pyでchunksだけ入れた場合:
+    # chunksがあるのにsessionsが空なら、chunksからセッションを移行する
+    if (
+        db.execute("SELECT 1 FROM sessions LIMIT 1").fetchone() is None
+        and db.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is not None
+    ):
+        db.execute("INSERT OR IGNORE INTO sessions (session_id) SELECT DISTINCT session_id FROM chunks")
+    # embeddingはfloat32のまま持つ。sqlite-vecにfloat16型はなく、int8量子化は
+    # 全件スキャンが2割ほど速くなるだけで、float32での再ランクなしでは再現率が大きく落ちる
     db.execute(f"""
         CREATE VIRTUAL TABLE IF NOT EXISTS chunks_vec
         USING vec0(
@@ -78,185 +197,179 @@ def get_db() -> sqlite3.Connection:
     return db
 
 
-def get_ingested_sessions(db: sqlite3.Connection) -> set[str]:
-    """既にインデックス済みのsession_idを取得する"""
-    rows = db.execute("SELECT DISTINCT session_id FROM chunks").fetchall()
-    return {r[0] for r in rows}
-
-
-def extract_text_from_content(content) -> str:
-    """メッセージのcontentからテキストを抽出する"""
-    if isinstance(content, str):
-        return content
-
-    if isinstance(content, list):
-        parts = []
-        for item in content:
-            if not isinstance(item, dict):
-                continue
-            item_type = item.get("type", "")
-
-            if item_type == "text":
-                text = item.get("text", "")
-                # system-reminderタグを除去
-                text = re.sub(r"<system-reminder>.*?</system-reminder>", "", text, flags=re.DOTALL)
-                text = text.strip()
-                if text:
-                    parts.append(text)
-
-            elif item_type == "tool_use":
-                tool_name = item.get("name", "unknown")
-                tool_input = item.get("input", {})
-                summary_parts = []
-                if isinstance(tool_input, dict):
-                    for key in ["command", "query", "pattern", "file_path", "prompt", "url"]:
-                        if key in tool_input:
-                            val = str(tool_input[key])[:100]
-                            summary_parts.append(f"{key}={val}")
-                input_summary = ", ".join(summary_parts) if summary_parts else ""
-                parts.append(f"[tool: {tool_name}({input_summary})]")
-
-            elif item_type == "tool_result":
-                result_content = item.get("content", "")
-                if isinstance(result_content, str):
-                    result_text = result_content[:150]
-                elif isinstance(result_content, list):
-                    texts = []
-                    for rc in result_content:
-                        if isinstance(rc, dict) and rc.get("type") == "text":
-                            texts.append(str(rc.get("text", ""))[:100])
-                    result_text = " ".join(texts)[:150]
-                else:
-                    result_text = ""
-                if result_text:
-                    parts.append(f"[result: {result_text}]")
-
-        return " ".join(parts)
-
-    return ""
-
-
-def parse_jsonl(filepath: Path) -> list[dict]:
-    """jsonlファイルからuser/assistantメッセージを抽出する"""
-    messages = []
-    session_id = filepath.stem
-
-    with open(filepath, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                obj = json.loads(line)
-            except json.JSONDecodeError:
-                continue
-
-            msg_type = obj.get("type", "")
-
-            if msg_type in SKIP_TYPES:
-                continue
-
-            if msg_type not in ("user", "assistant"):
-                continue
-
-            role = msg_type
-            content = None
-
-            if "message" in obj:
-                msg = obj["message"]
-                role = msg.get("role", msg_type)
-                content = msg.get("content")
-            elif "content" in obj:
-                content = obj["content"]
-            else:
-                continue
-
-            text = extract_text_from_content(content)
-            if not text or len(text.strip()) < 5:
-                continue
-
-            timestamp = obj.get("timestamp", "")
-
-            messages.append({
-                "role": role,
-                "text": text,
-                "timestamp": timestamp,
-                "session_id": session_id,
-            })
-
-    return messages
-
-
-def create_chunks(messages: list[dict], session_id: str, project_path: str) -> list[dict]:
-    """user/assistantペアのスライディングウィンドウでチャンクを作る"""
-    pairs = []
-    i = 0
-    while i < len(messages):
-        if messages[i]["role"] == "user":
-            user_msg = messages[i]
-            assistant_msg = None
-            if i + 1 < len(messages) and messages[i + 1]["role"] == "assistant":
-                assistant_msg = messages[i + 1]
-                i += 2
-            else:
-                i += 1
-            pairs.append((user_msg, assistant_msg))
+def get_ingested_sessions(db: sqlite3.Connection) -> dict[str, tuple[int | None, int | None]]:
+    """既にインデックス済みのsession_idと、その時点のファイルの (mtime_ns, size) を取得する
+
+    chunks全体を走査せず、セッション単位のsessionsテーブルから読む。
+    mtime/sizeが未記録のセッションは (None, None) になる。
+    """
+    rows = db.execute("SELECT session_id, mtime_ns, size FROM sessions").fetchall()
+    return {r[0]: (r[1], r[2]) for r in rows}
+
+
+def delete_session_chunks(db: sqlite3.Connection, session_id: str):
+    """セッションの既存チャンクを全テーブルから削除する（再パース前、コミットは呼び出し側）"""
+    old_ids = db.execute("SELECT chunk_id FROM chunks WHERE session_id = ?", (session_id,)).fetchall()
+    if not old_ids:
+        return
+    db.executemany("DELETE FROM chunks_vec WHERE chunk_id = ?", old_ids)
+    db.execute(
+        "DELETE FROM chunks_fts WHERE chunk_id IN (SELECT chunk_id FROM chunks WHERE session_id = ?)",
+        (session_id,),
+    )
+    db.execute("DELETE FROM chunks WHERE session_id = ?", (session_id,))
+
+
+def encode_passages(model: EmbeddingModel, prefixed: list[str]) -> np.ndarray:
+    """passageをトークン長順に並べてembeddingし、元の順序で返す（smart batching）
+
+    長さの近いテキスト同士でバッチを組むことで、パディングトークン分の無駄な計算を減らす。
+    短いバケットほどバッチを大きくして、1回の推論あたりのトークン数を揃える。
+    """
+    input_ids = model.tokenizer(prefixed, truncation=True, max_length=model.max_seq_length)["input_ids"]
+    lengths = np.array([len(ids) for ids in input_ids])
+    order = np.argsort(lengths, kind="stable")
+    sorted_lengths = lengths[order]
+
+    # 長さバケットごとにバッチサイズを変えてembeddingする。
+    # 最後のバケットは上限に関わらず残り全部を受け持ち、取りこぼしが出ないようにする
+    parts = []
+    start = 0
+    for i, (max_len, batch_size) in enumerate(ENCODE_BUCKETS):
+        if i == len(ENCODE_BUCKETS) - 1:
+            end = len(order)
         else:
-            i += 1
-
-    if not pairs:
-        return []
-
-    chunks = []
-    chunk_index = 0
-
-    for start in range(0, len(pairs), WINDOW_STEP):
-        end = min(start + WINDOW_SIZE, len(pairs))
-        window = pairs[start:end]
-
-        if not window:
-            break
-
-        lines = []
-        for user_msg, assistant_msg in window:
-            user_text = user_msg["text"][:500]
-            lines.append(f"User: {user_text}")
-            if assistant_msg:
-                assistant_text = assistant_msg["text"][:500]
-                lines.append(f"Assistant: {assistant_text}")
-
-        chunk_text = "\n".join(lines)
-        if len(chunk_text) > MAX_CHUNK_CHARS:
-            chunk_text = chunk_text[:MAX_CHUNK_CHARS]
-
-        timestamp = window[0][0].get("timestamp", "")
+            end = int(np.searchsorted(sorted_lengths, max_len, side="right"))
+        if end > start:
+            parts.append(model.encode([prefixed[i] for i in order[start:end]], batch_size=batch_size))
+        start = end
+    sorted_embeddings = np.concatenate(parts)
+
+    # 並べ替え前の位置に戻す
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(len(order))
+    return np.take(sorted_embeddings, inverse, axis=0)
+
+
+def store_chunks(db: sqlite3.Connection, chunks: list[dict], embeddings: np.ndarray) -> None:
+    """チャンクとembeddingをchunk_id単位でupsertする（コミットは呼び出し側）
+
+    同じchunk_idが複数あれば後勝ち。chunks_ftsには主キーがないため、
+    同じセッションの既存行は delete_session_chunks で先に消しておくこと。
+    """
+    # float32配列の各行をそのままBLOBとしてsqlite-vecに渡す（list化・packを省く）
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    chunk_rows = {}
+    vec_rows = {}
+    fts_rows = {}
+    for c, emb in zip(chunks, embeddings):
+        meta = c["metadata"]
+        chunk_rows[c["id"]] = (c["id"], c["text"], meta["session_id"], meta["project_path"], meta["timestamp"], meta["timestamp_epoch"], meta["chunk_index"])
+        vec_rows[c["id"]] = (c["id"], emb)
+        fts_rows[c["id"]] = (c["id"], c["text"])
+
+    db.executemany(
+        "INSERT OR REPLACE INTO chunks (chunk_id, text, session_id, project_path, timestamp, timestamp_epoch, chunk_index) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        chunk_rows.values(),
+    )
+    # vec0はINSERT OR REPLACE / OR IGNOREに対応していないので、消してから入れる
+    db.executemany("DELETE FROM chunks_vec WHERE chunk_id = ?", [(cid,) for cid in vec_rows])
+    db.executemany(
+        "INSERT INTO chunks_vec (chunk_id, embedding) VALUES (?, ?)",
+        vec_rows.values(),
+    )
+    db.executemany(
+        "INSERT INTO chunks_fts (chunk_id, text) VALUES (?, ?)",
+        fts_rows.values(),
+    )
+
+
+def get_stored_embeddings(db: sqlite3.Connection, session_ids: list[str], chunks: list[dict]) -> dict[str, np.ndarray]:
+    """本文が格納済みの行と同じチャンクについて、格納済みのembeddingを chunk_id → ベクトル で返す
+
+    chunk_idは session_id:chunk_index で決まるので、伸びたセッションでも
+    変わっていないウィンドウは同じidと本文になり、embeddingし直さずに済む。
+    """
+    stored_text = {}
+    for session_id in session_ids:
+        stored_text.update(db.execute("SELECT chunk_id, text FROM chunks WHERE session_id = ?", (session_id,)))
+
+    stored = {}
+    for c in chunks:
+        if stored_text.get(c["id"]) != c["text"]:
+            continue
+        row = db.execute("SELECT embedding FROM chunks_vec WHERE chunk_id = ?", (c["id"],)).fetchone()
+        if row is not None:
+            stored[c["id"]] = np.frombuffer(row[0], dtype=np.float32)
+    return stored
+
+
+def write_files(db: sqlite3.Connection, model: EmbeddingModel, files: list[tuple[Path, tuple[int, int], list[dict]]], verbose: bool) -> int:
+    """ファイル群のチャンクをまとめてembeddingして書き込み、格納チャンク数を返す（コミットは呼び出し側）
+
+    files の各要素は (filepath, (mtime_ns, size), chunks)。
+    再パースしたセッションは古いチャンクを消してから書き込む。
+    本文が変わっていないチャンクは格納済みのembeddingを使い回し、変わったものだけembeddingする。
+    """
+    all_chunks = [c for _, _, chunks in files for c in chunks]
+    stored = get_stored_embeddings(db, [filepath.stem for filepath, _, _ in files], all_chunks)
+    new_chunks = [c for c in all_chunks if c["id"] not in stored]
+    if verbose and stored:
+        print(f"  再利用: {len(stored)} チャンク（embedding対象 {len(new_chunks)} チャンク）")
+
+    embeddings = np.empty((len(all_chunks), EMBEDDING_DIM), dtype=np.float32)
+    if new_chunks:
+        # 同一テキストのチャンクは1回だけembeddingし、結果を重複分に配る
+        unique_index: dict[str, int] = {}
+        positions = [unique_index.setdefault(c["prefixed"], len(unique_index)) for c in new_chunks]
+        if verbose and len(unique_index) < len(new_chunks):
+            print(f"  重複除去: {len(new_chunks)} → {len(unique_index)} チャンク ({len(unique_index) / len(new_chunks):.0%})")
+        new_embeddings = iter(np.take(encode_passages(model, list(unique_index)), positions, axis=0))
+    for i, c in enumerate(all_chunks):
+        embeddings[i] = stored[c["id"]] if c["id"] in stored else next(new_embeddings)
+
+    for filepath, _, _ in files:
+        delete_session_chunks(db, filepath.stem)
+    store_chunks(db, all_chunks, embeddings)
+    db.executemany(
+        "INSERT OR REPLACE INTO sessions (session_id, mtime_ns, size) VALUES (?, ?, ?)",
+        [(filepath.stem, *stat) for filepath, stat, _ in files],
+    )
+    return len(all_chunks)
+
+
+def flush_pending(db: sqlite3.Connection, model: EmbeddingModel, pending: list[tuple[Path, tuple[int, int], list[dict]]], verbose: bool) -> tuple[int, int, int]:
+    """溜めたファイル群を1トランザクションで書き込む
+
+    バッチが失敗したら1ファイルずつ書き直し、失敗したファイルだけをエラーにする。
+
+    Returns:
+        (格納ファイル数, 格納チャンク数, エラー数)
+    """
+    try:
+        chunk_count = write_files(db, model, pending, verbose)
+        db.commit()
+        return len(pending), chunk_count, 0
+    except Exception as e:
+        db.rollback()
+        if len(pending) == 1:
+            if verbose:
+                print(f"  エラー ({pending[0][0].name}): {e}")
+            return 0, 0, 1
 
-        chunk_id = hashlib.md5(
-            f"{session_id}:{chunk_index}".encode()
-        ).hexdigest()
+    files = chunk_count = errors = 0
+    for item in pending:
+        try:
+            chunk_count += write_files(db, model, [item], verbose)
+            db.commit()
+            files += 1
+        except Exception as e:
+            db.rollback()
+            errors += 1
+            if verbose:
+                print(f"  エラー ({item[0].name}): {e}")
 
-        timestamp_epoch = 0.0
-        if timestamp:
-            try:
-                dt = datetime.fromisoformat(str(timestamp).replace("Z", "+00:00"))
-                timestamp_epoch = dt.timestamp()
-            except Exception:
-                pass
-
-        chunks.append({
-            "id": chunk_id,
-            "text": chunk_text,
-            "metadata": {
-                "session_id": session_id,
-                "project_path": project_path,
-                "timestamp": str(timestamp),
-                "timestamp_epoch": timestamp_epoch,
-                "chunk_index": chunk_index,
-            },
-        })
-        chunk_index += 1
-
-    return chunks
+    return files, chunk_count, errors
 
 
 def find_jsonl_files() -> list[tuple[Path, str]]:
@@ -275,13 +388,53 @@ def find_jsonl_files() -> list[tuple[Path, str]]:
     return results
 
 
+def _iter_parsed(targets: list[tuple[Path, str, tuple[int, int]]]):
+    """対象ファイルをパース + チャンク分割し、(filepath, stat, chunks, error) を順に返す
+
+    ファイルが少ないとき（フックの増分ingestでは伸びたセッション1〜2件が普通）は
+    ワーカー起動のほうが高くつくので、このプロセスでそのままパースする。
+    多いときはプロセスプールで並列に行い、終わったファイルから順に返す。
+    パースはembeddingよりずっと速いので、投入中のファイルはワーカー数の2倍までに抑え、
+    パース結果がメインプロセスに溜まり続けないようにする。
+    MCPサーバー（マルチスレッド）から呼ばれてもforkしないよう、ワーカーはspawnで起動する
+    """
+    if len(targets) < PARSE_WORKERS * 2:
+        for filepath, project_path, stat in targets:
+            try:
+                yield filepath, stat, _parse_and_chunk(filepath, project_path), None
+            except Exception as e:
+                yield filepath, stat, None, e
+        return
+
+    remaining = iter(targets)
+    with ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {}
+        for filepath, project_path, stat in itertools.islice(remaining, PARSE_WORKERS * 2):
+            futures[pool.submit(_parse_and_chunk, filepath, project_path)] = (filepath, stat)
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                filepath, stat = futures.pop(future)
+                # 1つ受け取ったら次の1ファイルを投入する
+                for next_path, next_project, next_stat in itertools.islice(remaining, 1):
+                    futures[pool.submit(_parse_and_chunk, next_path, next_project)] = (next_path, next_stat)
+                try:
+                    yield filepath, stat, future.result(), None
+                except Exception as e:
+                    yield filepath, stat, None, e
+
+
 def ingest(verbose: bool = True) -> dict:
     """メインのインジェスト処理"""
     if verbose:
         print("モデルをロード中...")
-    model = SentenceTransformer(EMBEDDING_MODEL)
+    model = EmbeddingModel()
 
     db = get_db()
+    # バルク書き込み中はコミットごとのfsyncを止め、最後に1回だけ同期する。
+    # 電源断では書き込み途中のDBが壊れうるが、インデックスはjsonlから再構築できる
+    db.execute("PRAGMA synchronous = OFF")
 
     ingested = get_ingested_sessions(db)
     if verbose:
@@ -296,61 +449,85 @@ def ingest(verbose: bool = True) -> dict:
     skipped = 0
     errors = 0
 
+    # mtime/sizeが記録と一致するファイルは開かずにスキップする。
+    # サイズが変わったセッション（進行中で伸びたログ）だけ再パースする
+    targets = []
+    stat_updates = []  # 再パース不要だがmtime/sizeの記録だけ更新するセッション
+    seen_sessions = set()
     for filepath, project_path in jsonl_files:
         session_id = filepath.stem
-        if session_id in ingested:
+        if session_id in seen_sessions:
+            # 別プロジェクトに同名のjsonlがある場合は最初の1つだけ扱う
+            # （記録が1セッション1行なので、両方見ると毎回片方が再パースされる）
             skipped += 1
             continue
-
         try:
-            messages = parse_jsonl(filepath)
-            if not messages:
+            st = filepath.stat()
+        except OSError as e:
+            # find_jsonl_files() の後に削除されたファイルなど
+            errors += 1
+            if verbose:
+                print(f"  エラー ({filepath.name}): {e}")
+            continue
+        seen_sessions.add(session_id)
+        stat = (st.st_mtime_ns, st.st_size)
+        if session_id in ingested:
+            known_mtime, known_size = ingested[session_id]
+            if known_size is None or known_size == st.st_size:
+                if known_mtime != st.st_mtime_ns:
+                    stat_updates.append((session_id, *stat))
                 skipped += 1
                 continue
+        targets.append((filepath, project_path, stat))
 
-            chunks = create_chunks(messages, session_id, project_path)
-            if not chunks:
-                skipped += 1
-                continue
+    # 複数ファイルのチャンクを溜めてからまとめてembeddingする
+    pending: list[tuple[Path, tuple[int, int], list[dict]]] = []
+    pending_count = 0
 
-            # embedding
-            texts = [c["text"] for c in chunks]
-            prefixed_texts = [f"passage: {t}" for t in texts]
-            embeddings = model.encode(prefixed_texts, show_progress_bar=False).tolist()
-
-            # SQLite格納
-            for j, c in enumerate(chunks):
-                meta = c["metadata"]
-                emb = embeddings[j]
-
-                db.execute(
-                    "INSERT OR IGNORE INTO chunks (chunk_id, text, session_id, project_path, timestamp, timestamp_epoch, chunk_index) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (c["id"], c["text"], meta["session_id"], meta["project_path"], meta["timestamp"], meta["timestamp_epoch"], meta["chunk_index"]),
-                )
-                db.execute(
-                    "INSERT OR IGNORE INTO chunks_vec (chunk_id, embedding) VALUES (?, ?)",
-                    (c["id"], serialize_f32(emb)),
-                )
-                db.execute(
-                    "INSERT OR IGNORE INTO chunks_fts (chunk_id, text) VALUES (?, ?)",
-                    (c["id"], c["text"]),
-                )
+    for filepath, stat, chunks, error in _iter_parsed(targets):
+        if error is not None:
+            errors += 1
+            if verbose:
+                print(f"  エラー ({filepath.name}): {error}")
+            continue
 
-            db.commit()
-            new_files += 1
-            new_chunks += len(chunks)
+        if not chunks:
+            # チャンクにならないファイルも記録し、伸びるまで開かない
+            stat_updates.append((filepath.stem, *stat))
+            skipped += 1
+            continue
 
-            if verbose and new_files % 20 == 0:
+        pending.append((filepath, stat, chunks))
+        pending_count += len(chunks)
+        if pending_count >= WRITE_BATCH_SIZE:
+            files, chunk_count, errs = flush_pending(db, model, pending, verbose)
+            new_files += files
+            new_chunks += chunk_count
+            errors += errs
+            pending = []
+            pending_count = 0
+            if verbose:
                 print(f"  処理済み: {new_files} ファイル, {new_chunks} チャンク")
 
-        except Exception as e:
-            errors += 1
-            if verbose:
-                print(f"  エラー ({filepath.name}): {e}")
+    if pending:
+        files, chunk_count, errs = flush_pending(db, model, pending, verbose)
+        new_files += files
+        new_chunks += chunk_count
+        errors += errs
+
+    if stat_updates:
+        db.executemany(
+            "INSERT OR REPLACE INTO sessions (session_id, mtime_ns, size) VALUES (?, ?, ?)",
+            stat_updates,
+        )
+        db.commit()
 
     total_in_db = db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
     db.close()
 
+    with open(SQLITE_PATH, "rb+") as f:
+        os.fsync(f.fileno())
+
     result = {
         "new_files": new_files,
         "new_chunks": new_chunks,
@@ -370,5 +547,55 @@ def ingest(verbose: bool = True) -> dict:
     return result
 
 
+def reembed(verbose: bool = True) -> int:
+    """格納済みの全チャンクを今のモデルでembeddingし直し、件数を返す
+
+    ingest() は変わっていないセッションを作り直さないので、ONNX版より前
+    （PyTorch fp32のSentenceTransformerやChromaDBからの移行分）のベクトルは
+    INT8モデルのクエリベクトルと混ざったまま残る。モデルや量子化設定を変えたら一度実行する。
+    """
+    if verbose:
+        print("モデルをロード中...")
+    model = EmbeddingModel()
+
+    db = get_db()
+    db.execute("PRAGMA synchronous = OFF")
+
+    total = 0
+    last_rowid = 0
+    while True:
+        rows = db.execute(
+            "SELECT rowid, chunk_id, text FROM chunks WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (last_rowid, WRITE_BATCH_SIZE),
+        ).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+
+        embeddings = np.ascontiguousarray(
+            encode_passages(model, [f"passage: {text}" for _, _, text in rows]), dtype=np.float32
+        )
+        db.executemany("DELETE FROM chunks_vec WHERE chunk_id = ?", [(chunk_id,) for _, chunk_id, _ in rows])
+        db.executemany(
+            "INSERT INTO chunks_vec (chunk_id, embedding) VALUES (?, ?)",
+            [(chunk_id, emb) for (_, chunk_id, _), emb in zip(rows, embeddings)],
+        )
+        db.commit()
+        total += len(rows)
+        if verbose:
+            print(f"  再embedding済み: {total} チャンク")
+
+    db.close()
+    with open(SQLITE_PATH, "rb+") as f:
+        os.fsync(f.fileno())
+
+    if verbose:
+        print(f"\n完了: {total} チャンクを再embedding")
+    return total
+
+
 if __name__ == "__main__":
-    ingest()
+    if "--reembed" in sys.argv[1:]:
+        reembed()
+    else:
+        ingest()
@@ -6,21 +6,22 @@ sqlite-vec (ベクトル検索) + FTS5 (キーワード検索) → RRF統合。
 stdio方式で動作し、Claude Codeから直接呼び出せる。
 """
 
-import json
-import re
+import functools
 import sqlite3
 import struct
+import threading
 from pathlib import Path
 
 from mcp.server.fastmcp import FastMCP
-from sentence_transformers import SentenceTransformer
+import orjson
 import sqlite_vec
 
 from ingest import (
     DATA_DIR,
     SQLITE_PATH,
-    EMBEDDING_MODEL,
     EMBEDDING_DIM,
+    EmbeddingModel,
+    _PROJECT_PREFIX_RE,
     get_db,
     ingest,
 )
@@ -28,18 +29,36 @@ from ingest import (
 # --- RRF定数 ---
 RRF_K = 60  # Reciprocal Rank Fusion の k パラメータ
 
+# --- 結果の本文長 ---
+CONVERSATION_CHARS = 1500  # limit が小さいときに返す本文の長さ
+PREVIEW_CHARS = 500  # limit が大きいときはプレビューだけ返す（全文は memory_get で取得）
+PREVIEW_LIMIT_THRESHOLD = 5  # これを超える limit ではプレビューにする
+
 # --- グローバル初期化（起動時に1回だけ） ---
 _model = None
+_model_lock = threading.Lock()  # 起動時のウォームアップスレッドと検索の同時ロードを防ぐ
 _db = None
 
 
-def _get_model() -> SentenceTransformer:
+def _get_model() -> EmbeddingModel:
     global _model
-    if _model is None:
-        _model = SentenceTransformer(EMBEDDING_MODEL)
+    with _model_lock:
+        if _model is None:
+            _model = EmbeddingModel()
     return _model
 
 
+def _warmup():
+    """モデルのロードと初回推論を済ませておく（最初の検索でロード待ちが発生しないように）"""
+    _get_model().encode("query: warmup")
+
+
+@functools.lru_cache(maxsize=512)
+def _embed_query(query: str) -> tuple[float, ...]:
+    """クエリのembedding（同じクエリの再検索ではモデル推論を省く）"""
+    return tuple(_get_model().encode(f"query: {query}").tolist())
+
+
 def _get_db() -> sqlite3.Connection:
     global _db
     if _db is None:
@@ -139,6 +158,11 @@ def _fts_search(db: sqlite3.Connection, query: str, limit: int, epoch_from: floa
     return [(chunk_id, rank_pos + 1) for rank_pos, (chunk_id, _) in enumerate(rows)]
 
 
+def _format_project(project_path: str) -> str:
+    """プロジェクトディレクトリ名を表示用のパスに戻す"""
+    return _PROJECT_PREFIX_RE.sub("", project_path).replace("-", "/")
+
+
 def _rrf_merge(vec_results: list[tuple[str, int]], fts_results: list[tuple[str, int]], limit: int) -> list[str]:
     """RRF (Reciprocal Rank Fusion) で2つのランキングを統合"""
     scores: dict[str, float] = {}
@@ -171,19 +195,19 @@ def memory_search(query: str, limit: int = 5, date_from: str = "", date_to: str
 
     Args:
         query: 検索クエリ（日本語・英語どちらでも可）
-        limit: 返す結果の最大数（デフォルト: 5）
+        limit: 返す結果の最大数（デフォルト: 5、最大20）。5を超えると本文は
+            conversation_preview（先頭500文字）になるので、全文は memory_get で取得する
         date_from: 検索開始日（ISO 8601形式、例: "2026-03-05"）。この日以降の会話に絞る
         date_to: 検索終了日（ISO 8601形式、例: "2026-03-06"）。この日より前の会話に絞る
     """
-    model = _get_model()
     db = _get_db()
 
     total = db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
     if total == 0:
-        return json.dumps({
+        return orjson.dumps({
             "error": "インデックスが空です。先に memory_ingest を実行してください。",
             "results": [],
-        }, ensure_ascii=False)
+        }).decode()
 
     # 日付フィルタ
     from datetime import datetime as _dt, timezone as _tz
@@ -195,7 +219,7 @@ def memory_search(query: str, limit: int = 5, date_from: str = "", date_to: str
         pass
 
     # ベクトル検索
-    query_embedding = model.encode(f"query: {query}", show_progress_bar=False).tolist()
+    query_embedding = list(_embed_query(query))
     vec_results = _vector_search(db, query_embedding, limit, epoch_from, epoch_to)
 
     # FTS5キーワード検索
@@ -217,20 +241,22 @@ def memory_search(query: str, limit: int = 5, date_from: str = "", date_to: str
     vec_ids = {cid for cid, _ in vec_results}
     fts_ids = {cid for cid, _ in fts_results}
 
+    # 本文はSQLite側で切り詰めてから取り出す
+    if limit > PREVIEW_LIMIT_THRESHOLD:
+        text_key, text_chars = "conversation_preview", PREVIEW_CHARS
+    else:
+        text_key, text_chars = "conversation", CONVERSATION_CHARS
+
     for chunk_id in merged_ids:
         row = db.execute(
-            "SELECT text, session_id, project_path, timestamp FROM chunks WHERE chunk_id = ?",
-            (chunk_id,),
+            "SELECT substr(text, 1, ?), session_id, project_path, timestamp FROM chunks WHERE chunk_id = ?",
+            (text_chars, chunk_id),
         ).fetchone()
         if row is None:
             continue
 
         text, session_id, project_path, timestamp = row
 
-        project = project_path
-        project = re.sub(r"^-mnt-c-Users-[^-]+-", "", project)
-        project = project.replace("-", "/")
-
         hit_sources = []
         if chunk_id in vec_ids:
             hit_sources.append("vec")
@@ -238,19 +264,50 @@ def memory_search(query: str, limit: int = 5, date_from: str = "", date_to: str
             hit_sources.append("fts")
 
         formatted.append({
+            "id": chunk_id,
             "score": round(rrf_scores.get(chunk_id, 0.0), 4),
             "hit": "+".join(hit_sources),
-            "project": project,
+            "project": _format_project(project_path),
             "session_id": session_id[:8] + "...",
             "timestamp": timestamp,
-            "conversation": text[:1500],
+            text_key: text,
         })
 
-    return json.dumps({
+    return orjson.dumps({
         "query": query,
         "total_indexed": total,
         "results": formatted,
-    }, ensure_ascii=False, indent=2)
+    }, option=orjson.OPT_INDENT_2).decode()
+
+
+@mcp.tool()
+def memory_get(chunk_id: str) -> str:
+    """memory_search の結果の会話チャンクを全文で取得する。
+
+    memory_search の limit が大きい時は本文がプレビューだけになるので、
+    詳しく読みたい結果があればその id を指定して呼ぶ。
+
+    Args:
+        chunk_id: memory_search の結果に含まれる id
+    """
+    db = _get_db()
+    row = db.execute(
+        "SELECT text, session_id, project_path, timestamp FROM chunks WHERE chunk_id = ?",
+        (chunk_id,),
+    ).fetchone()
+    if row is None:
+        return orjson.dumps({
+            "error": f"チャンクが見つかりません: {chunk_id}",
+        }).decode()
+
+    text, session_id, project_path, timestamp = row
+    return orjson.dumps({
+        "id": chunk_id,
+        "project": _format_project(project_path),
+        "session_id": session_id[:8] + "...",
+        "timestamp": timestamp,
+        "conversation": text,
+    }, option=orjson.OPT_INDENT_2).decode()
 
 
 @mcp.tool()
@@ -262,15 +319,18 @@ def memory_ingest() -> str:
     初回実行時はモデルのダウンロードも含めて時間がかかる場合がある。
     """
     result = ingest(verbose=False)
-    return json.dumps({
+    return orjson.dumps({
         "status": "完了",
         "new_files": result["new_files"],
         "new_chunks": result["new_chunks"],
         "skipped_files": result["skipped"],
         "errors": result["errors"],
         "total_chunks_in_index": result["total_in_collection"],
-    }, ensure_ascii=False, indent=2)
+    }, option=orjson.OPT_INDENT_2).decode()
 
 
 if __name__ == "__main__":
+    # DB接続は検索と同じスレッドで開き、モデルはMCPハンドシェイクと並行してロードする
+    _get_db()
+    threading.Thread(target=_warmup, daemon=True).start()
     mcp.run(transport="stdio")